@@ -19,10 +19,15 @@ name=^postgres,^pg
 exe and name are both lists of comma-separated regexps.
 """
 
+import errno
+import os
 import re
+import sys
 import diamond.collector
 import diamond.convertor
+import threading
 import time
+import weakref
 
 try:
     import psutil
@@ -31,35 +36,340 @@ except ImportError:
     psutil = None
 
 
-def process_filter(proc, cfg):
+# flags re.compile sets on a regexp without any inline flags of its own
+DEFAULT_FLAGS = re.compile('').flags
+
+# backreferences and conditionals refer to groups by number or name, which
+#  would change once the regexp is folded into a larger one
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+# ^ followed only by characters that stand for themselves in a regexp, spelt
+#  out rather than left to re.escape, which escapes less on newer Pythons
+LITERAL_PREFIX = re.compile(r'\^([\w/,:;=@%~-]+)\Z')
+
+# regexp string --> compiled regexp, and tuple of regexp strings --> search
+#  function from combine_patterns, so that rebuilding the process descriptors
+#  never compiles the same regexp twice
+compiled_patterns = {}
+combined_patterns = {}
+
+# the process list is rescanned at most once every RELOAD_INTERVAL seconds,
+#  and the background scan starts that long before the next collect is due
+RELOAD_INTERVAL = 10
+
+
+def compile_pattern(pattern):
+    """
+    Compiles a regexp, reusing the result of any earlier call
+
+    :param pattern: a regexp string
+    :return: the compiled regexp
+    """
+    if pattern not in compiled_patterns:
+        compiled_patterns[pattern] = re.compile(pattern)
+    return compiled_patterns[pattern]
+
+
+def can_combine(pattern):
+    """
+    Decides whether a regexp can be folded into an alternation with others
+    without changing what any of them match. It mustn't set global inline
+    flags such as (?i), which would apply to the whole alternation (or be
+    rejected altogether on newer Pythons), use named groups, which could
+    clash, or refer back to its groups, which would be renumbered.
+
+    :param pattern: a regexp string
+    :rtype: bool
+    """
+    compiled = compile_pattern(pattern)
+    return (compiled.flags == DEFAULT_FLAGS and not compiled.groupindex and
+            not GROUP_REFERENCE.search(pattern))
+
+
+def search_any(searches):
+    """
+    :param searches: a list of regexp search methods
+    :return: a function searching a string with each of them in turn
+    """
+    def search(string):
+        for s in searches:
+            match = s(string)
+            if match:
+                return match
+        return None
+    return search
+
+
+def combine_patterns(patterns):
+    """
+    Folds a list of regexps into a single alternation, so that a process can
+    be tested against all of them with one call into the regex engine. Each
+    regexp is compiled on its own first, and those that can't be folded
+    safely are searched with separately.
+
+    :param patterns: a list of regexp strings
+    :return: a function searching a string for any of the regexps, or None
+        if there are no patterns to match with
+    """
+    if not patterns:
+        return None
+    key = tuple(patterns)
+    if key not in combined_patterns:
+        combinable = [p for p in patterns if can_combine(p)]
+        searches = [compile_pattern(p).search for p in patterns
+                    if p not in combinable]
+        try:
+            if len(combinable) > 1:
+                pattern = '|'.join('(?:%s)' % p for p in combinable)
+                searches.insert(0, compile_pattern(pattern).search)
+            elif combinable:
+                searches.insert(0, compile_pattern(combinable[0]).search)
+        except re.error:
+            searches = [compile_pattern(p).search for p in patterns]
+        if len(searches) == 1:
+            combined_patterns[key] = searches[0]
+        else:
+            combined_patterns[key] = search_any(searches)
+    return combined_patterns[key]
+
+
+def literal_prefix(pattern):
+    """
+    Recognises regexps of the form ^literal, which can be tested with a plain
+    str.startswith instead of going through the regex engine
+
+    :param pattern: a regexp string
+    :return: the literal the pattern matches at the start of a string, or
+        None if the pattern is anything else
+    """
+    match = LITERAL_PREFIX.match(pattern)
+    return match.group(1) if match else None
+
+
+def read_proc_file(path):
+    """
+    Reads a file from /proc, decoding it with the filesystem encoding and
+    error handler like psutil does, so that bytes which aren't valid in the
+    locale's encoding don't cost us the process
+
+    :param path: the path of the file
+    :return: its contents, or None if it could not be read, which usually
+        means the process has gone away or belongs to another user
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    # Python 2 keeps these as byte strings, as psutil does
+    if str is bytes:
+        return data
+    return os.fsdecode(data)
+
+
+def is_zombie(path):
+    """
+    :param path: the /proc/<pid>/ directory of a process
+    :return: True if the process is a zombie, whose exe and cmdline psutil
+        reports as unknown
+    :rtype: bool
+    """
+    stat = read_proc_file(path + 'stat')
+    if stat is None:
+        return False
+    rpar = stat.rfind(')')
+    return stat[rpar + 2:rpar + 3] == 'Z'
+
+
+def scan_linux(read_cmdline=True, read_exe=True):
+    """
+    Walks /proc directly, reading only the files process_filter needs. This
+    is a lot cheaper than psutil.process_iter, which builds and validates a
+    psutil.Process for every pid on the system, most of which we then throw
+    away. Names, command lines and exes are read the same way psutil does.
+
+    :param read_cmdline: whether to read the command lines of the processes
+    :param read_exe: whether to read the exes of the processes
+    :return: an iterator of (info, None) tuples, where info is a dictionary
+        holding the pid, name, exe and cmdline of a process, the same as the
+        info process_iter(attrs=...) would fill in. exe and cmdline are None
+        when they weren't asked for.
+    """
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        path = '/proc/' + entry + '/'
+        name = read_proc_file(path + 'comm')
+        if name is None:
+            continue
+        if name.endswith('\n'):
+            name = name[:-1]
+
+        # only looked up when needed, as both the cmdline and exe of kernel
+        #  threads come back empty
+        zombie = None
+
+        # long names need the command line to be recovered, see below
+        cmdline = None
+        if read_cmdline or len(name) >= 15:
+            cmdline = read_proc_file(path + 'cmdline')
+        if cmdline == '':
+            zombie = is_zombie(path)
+            cmdline = None if zombie else []
+        elif cmdline is not None:
+            # arguments are NUL separated, unless the process rewrote its
+            #  command line with spaces instead
+            data = cmdline
+            sep = '\x00' if data.endswith('\x00') else ' '
+            if data.endswith(sep):
+                data = data[:-1]
+            cmdline = data.split(sep)
+            if sep == '\x00' and len(cmdline) == 1 and ' ' in data:
+                cmdline = data.split(' ')
+            # comm is truncated to 15 characters, so try to recover the full
+            #  name from the command line
+            if len(name) >= 15 and cmdline:
+                extended_name = os.path.basename(cmdline[0])
+                if extended_name.startswith(name):
+                    name = extended_name
+            if not read_cmdline:
+                cmdline = None
+
+        exe = None
+        if read_exe:
+            try:
+                exe = os.readlink(path + 'exe').split('\x00')[0]
+                if exe.endswith(' (deleted)') and not os.path.exists(exe):
+                    exe = exe[:-10]
+            except OSError as e:
+                # kernel threads have no exe, which psutil reports as ''
+                if (e.errno in (errno.ENOENT, errno.ESRCH) and
+                        os.path.lexists(path)):
+                    if zombie is None:
+                        zombie = is_zombie(path)
+                    if not zombie:
+                        exe = ''
+
+        yield {'pid': int(entry), 'name': name, 'exe': exe,
+               'cmdline': cmdline}, None
+
+
+class ProcessGroup(object):
+    """
+    Describes a process group from the `process` section of the config file:
+        exe: search function from combine_patterns, or None
+        name: search function from combine_patterns, or None
+        cmdline: search function from combine_patterns, or None
+        cmdline_literals: (string) of the ^literal cmdline regexps
+        procs: {pid => (psutil.Process, create time, cpu metric, ram metric)}
+        tracked: [(pid, psutil.Process, cpu metric, ram metric)]
+        title: metric-safe processgroup name
+        naming_method: [string] or None to use the collector's
+        use_config_title: whether metrics are named after the title
+    """
+    __slots__ = ('exe', 'name', 'cmdline', 'cmdline_literals', 'procs',
+                 'tracked', 'title', 'naming_method', 'use_config_title')
+
+    def __init__(self, title=None, naming_method=None):
+        self.exe = None
+        self.name = None
+        self.cmdline = None
+        self.cmdline_literals = ()
+        self.procs = {}
+        self.tracked = []
+        self.title = title
+        self.naming_method = naming_method
+        self.use_config_title = False
+
+
+def process_filter(info, cfg, cmdline):
     """
     Decides whether a process matches with a given process descriptor
 
-    :param proc: a psutil.Process instance
-    :param cfg: the dictionary from processes that describes with the
-        process group we're testing for
+    :param info: the dictionary holding the exe and name of the process, as
+        filled in by process_iter(attrs=...) or scan_linux
+    :param cfg: the ProcessGroup from processes that describes the process
+        group we're testing for
+    :param cmdline: the process' command line joined into a single string, or
+        None if it could not be read
     :return: True if it matches
     :rtype: bool
     """
-    for exe in cfg['exe']:
-        try:
-            if exe.search(proc.exe):
-                return True
-        except psutil.AccessDenied:
-            break
-    for name in cfg['name']:
-        if name.search(proc.name):
+    if (cfg.name is None and cfg.cmdline is None and
+            not cfg.cmdline_literals and cfg.exe is None):
+        return False
+    # test the cheapest attributes first, exe and cmdline are None when
+    #  access to them was denied
+    if cfg.name is not None:
+        if cfg.name(info['name']):
             return True
-    for cmdline in cfg['cmdline']:
-        if cmdline.search(' '.join(proc.cmdline)):
+    if cmdline is not None:
+        if cfg.cmdline_literals and cmdline.startswith(cfg.cmdline_literals):
+            return True
+        if cfg.cmdline is not None and cfg.cmdline(cmdline):
+            return True
+    if cfg.exe is not None and info['exe'] is not None:
+        if cfg.exe(info['exe']):
             return True
     return False
 
 
+def refresh_loop(collector_ref, refresh_wanted, stopped):
+    """
+    Body of the refresh thread, which rescans the system whenever collect
+    asks for it, so that collect never has to wait on a full process scan.
+    It only holds a weak reference to the collector, so that the collector
+    can still be garbage collected, which stops the thread.
+
+    :param collector_ref: a weakref.ref to the ProcessCollector
+    :param refresh_wanted: the threading.Event collect sets to ask for a scan
+    :param stopped: the threading.Event set once the thread should exit
+    """
+    while True:
+        refresh_wanted.wait()
+        refresh_wanted.clear()
+        if stopped.is_set():
+            return
+        collector = collector_ref()
+        if collector is None:
+            return
+        # hold off until shortly before the next collect, so that it picks up
+        #  a list that is as fresh as possible
+        delay = collector.refresh_at - time.time()
+        del collector
+        if delay > 0:
+            stopped.wait(delay)
+            if stopped.is_set():
+                return
+        collector = collector_ref()
+        if collector is None:
+            return
+        try:
+            collector.refresh_processes()
+        except Exception:
+            collector.log.exception('ProcessCollector: failed to refresh processes')
+        del collector
+
+
 class ProcessCollector(diamond.collector.Collector):
 
     def __init__(self, config, handlers):
         super(ProcessCollector, self).__init__(config, handlers)
+        self.processes = {}
+        self.processes_config = None
+        self.any_process = None
+        self.prefilter = False
+        self.mem_unit = None
+        self.mem_scale = 1
+        # guards swapping self.processes and the descriptors' procs/tracked
+        #  between the refresh thread and collect
+        self.lock = threading.Lock()
+        self.refresh_thread = None
+        self.refresh_wanted = threading.Event()
+        self.stopped = threading.Event()
+        # serializes scans between the refresh thread and collect
+        self.refresh_lock = threading.Lock()
+        self.refresh_at = 0
         self.last_reload = 0
 
     def get_default_config_help(self):
@@ -93,73 +403,256 @@ class ProcessCollector(diamond.collector.Collector):
 
     def setup_config(self):
         """
-        prepare self.processes, which is a descriptor dictionary in
-        processgroup --> {
-            exe: [regex],
-            name: [regex],
-            cmdline: [regex],
-            procs: {pid => psutil.Process}
-            naming_method: [string]
-        }
+        prepare self.processes, which is a dictionary of
+        processgroup --> ProcessGroup
+
+        along with self.any_process, a ProcessGroup matching the union of all of
+        the process groups. When all of the regexps can be folded into it
+        (see can_combine), self.prefilter is set and filter_processes uses it
+        to reject the processes we aren't interested in without testing each
+        group in turn.
+
+        The descriptors are only rebuilt (and their regexps recompiled) when
+        the `process` section of the config has changed since the last call.
         """
-        self.processes = {}
+        processes_config = repr(self.config['process'])
+        if processes_config == self.processes_config:
+            return
+        self.processes_config = processes_config
+
+        processes = {}
+        any_process = ProcessGroup()
+        patterns = {'exe': [], 'name': [], 'cmdline': []}
         for process, cfg in self.config['process'].items():
-            # first we build a dictionary with the process aliases and the
+            # first we build a descriptor with the process aliases and the
             #  matching regexps
-            proc = {'procs': {}}
+            group = ProcessGroup(process.replace('.', '_'),
+                                 cfg.get('naming_method'))
             for key in ('exe', 'name', 'cmdline'):
-                proc[key] = cfg.get(key, [])
-                if not isinstance(proc[key], list):
-                    proc[key] = [proc[key]]
-                proc[key] = [re.compile(e) for e in proc[key]]
-            if cfg.has_key('naming_method'):
-                proc['naming_method'] = cfg.get('naming_method')
-            self.processes[process] = proc
+                values = cfg.get(key, [])
+                if not isinstance(values, list):
+                    values = [values]
+                if key == 'cmdline':
+                    # plain prefixes are cheaper to test without a regexp
+                    literals = [literal_prefix(e) for e in values]
+                    group.cmdline_literals = tuple(l for l in literals
+                                                   if l is not None)
+                    values = [e for e, l in zip(values, literals)
+                              if l is None]
+                    any_process.cmdline_literals += group.cmdline_literals
+                patterns[key].extend(values)
+                setattr(group, key, combine_patterns(values))
+            processes[process] = group
+        for key, values in patterns.items():
+            setattr(any_process, key, combine_patterns(values))
+
+        # any_process and prefilter are only ever used by the refresh thread
+        self.any_process = any_process
+        self.prefilter = all(can_combine(p) for values in patterns.values()
+                             for p in values)
+        with self.lock:
+            self.processes = processes
 
     def filter_processes(self):
         """
-        Populates self.processes[processname]['procs'] with the corresponding
-        list of psutil.Process instances
+        Populates self.processes[processname].procs with the corresponding
+        psutil.Process instances, along with their create time and the names
+        of the metrics to publish for them, and rebuilds the .tracked
+        snapshot that collect iterates over
+
+        The scan is done on fresh dictionaries which are only swapped in once
+        complete, so collect never sees a half-filled process group.
         """
+        # only the refresh thread replaces self.processes, so no need to lock
+        processes = self.processes
+        procs = dict((process, {}) for process in processes)
+        naming_method = self.config.get('naming_method', 'process_name')
+        for cfg in processes.values():
+            cfg.use_config_title = ((cfg.naming_method or naming_method) ==
+                                    'config_title')
+        separate_pids = self.config['separate_pids']
 
-        for proc in psutil.process_iter():
+        for info, proc in self.scan_processes():
+            # join the command line once for all of the process groups
+            cmdline = info.get('cmdline')
+            if cmdline is not None:
+                cmdline = ' '.join(cmdline)
+            # most processes match none of the groups, so weed those out
+            #  with a single test before looking for the matching group
+            if self.prefilter and not process_filter(info, self.any_process,
+                                                     cmdline):
+                continue
             # filter and divide the system processes amongst the different
             #  process groups defined in the config file
-            for procname, cfg in self.processes.items():
-                if process_filter(proc, cfg):
-                    cfg['procs'][proc.pid] = proc
+            for procname, cfg in processes.items():
+                if process_filter(info, cfg, cmdline):
+                    # only build a psutil.Process for the processes we track
+                    if proc is None:
+                        try:
+                            proc = psutil.Process(info['pid'])
+                            info['create_time'] = proc.create_time()
+                        except psutil.NoSuchProcess:
+                            break
+                    # keep tracking the same instance for as long as the pid
+                    #  hasn't been reused, so cpu_percent carries on measuring
+                    #  from its last sample instead of starting over at 0.0
+                    previous = cfg.procs.get(proc.pid)
+                    if previous is not None and previous[1] == info['create_time']:
+                        proc = previous[0]
+                    # a process keeps its name and pid for as long as it lives,
+                    #  so build its metric names once here instead of on
+                    #  every collect
+                    if cfg.use_config_title:
+                        metric_prefix = cfg.title
+                    else:
+                        metric_prefix = info['name'].replace('.', '_')
+                    if separate_pids:
+                        metric_prefix = '.'.join([metric_prefix, str(proc.pid)])
+                    procs[procname][proc.pid] = (proc, info['create_time'],
+                                                 metric_prefix + '.cpu',
+                                                 metric_prefix + '.ram')
                     break
 
-    def collect(self):
+        tracked = dict((process, [(pid, proc, cpu_metric, ram_metric)
+                                  for pid, (proc, create_time, cpu_metric, ram_metric)
+                                  in procs[process].items()])
+                       for process in processes)
+        with self.lock:
+            for process, cfg in processes.items():
+                cfg.procs = procs[process]
+                cfg.tracked = tracked[process]
+
+    def scan_processes(self):
         """
-        Collects the CPU and memory usage of each process defined under the
-        `process` subsection of the config file
+        Lists the processes running on the system for filter_processes
+
+        :return: an iterator of (info, psutil.Process or None) tuples, see
+            scan_linux for the contents of info
         """
+        # don't bother fetching the attributes none of the groups match on,
+        #  exes in particular are often denied to us anyway
+        read_cmdline = (self.any_process.cmdline is not None or
+                        bool(self.any_process.cmdline_literals))
+        read_exe = self.any_process.exe is not None
+
+        if sys.platform.startswith('linux'):
+            return scan_linux(read_cmdline, read_exe)
+        # fetch everything process_filter needs in a single pass
+        attrs = ['pid', 'name', 'create_time']
+        if read_cmdline:
+            attrs.append('cmdline')
+        if read_exe:
+            attrs.append('exe')
+        return ((proc.info, proc) for proc in
+                psutil.process_iter(attrs=attrs, ad_value=None))
 
-        # Only reload the process list every 10 seconds,
-        if time.time() - self.last_reload > 10:
+    def refresh_processes(self, max_age=None):
+        """
+        Brings the process descriptors up to date with the config and rescans
+        the system for the processes they match
+
+        :param max_age: if given, skip the scan when the last one finished at
+            most this many seconds ago, e.g. when the other thread did it
+            while we were waiting for it
+        """
+        with self.refresh_lock:
+            if max_age is not None and time.time() - self.last_reload <= max_age:
+                return
             self.setup_config()
             self.filter_processes()
             self.last_reload = time.time()
 
+    def start_refresh_thread(self):
+        """
+        Starts the thread running refresh_loop, which lives until stop is
+        called or the collector is garbage collected
+        """
+        refresh_wanted = self.refresh_wanted
+        stopped = self.stopped
+
+        def collected(collector_ref):
+            stopped.set()
+            refresh_wanted.set()
+
+        self.refresh_thread = threading.Thread(
+            target=refresh_loop,
+            args=(weakref.ref(self, collected), refresh_wanted, stopped))
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+
+    def stop(self):
+        """
+        Stops the refresh thread
+        """
+        self.stopped.set()
+        self.refresh_wanted.set()
+
+    def collect(self):
+        """
+        Collects the CPU and memory usage of each process defined under the
+        `process` subsection of the config file
+        """
+
+        # The process list is reloaded in the background, we only do the
+        #  first scan here so there is something to collect straight away.
+        #  The thread is started lazily as diamond may fork the collector
+        #  after constructing it. Should the background scan not have kept
+        #  up, rescan here rather than collect from an outdated list.
+        interval = float(self.config['interval'])
+        if self.refresh_thread is None:
+            self.refresh_processes()
+            self.start_refresh_thread()
+        elif time.time() - self.last_reload > max(interval, 2 * RELOAD_INTERVAL):
+            self.refresh_processes(max_age=RELOAD_INTERVAL)
+
+        # have the next scan finish shortly before the next collect, but
+        #  still scan at most every RELOAD_INTERVAL seconds
+        self.refresh_at = max(time.time() + interval - RELOAD_INTERVAL,
+                              self.last_reload + RELOAD_INTERVAL)
+        self.refresh_wanted.set()
+
+        # converting between units is a plain multiplication, so resolve
+        #  the factor once per unit rather than once per process
         unit = self.config['unit']
-        naming_method = self.config.get('naming_method', 'process_name')
-        for process, cfg in self.processes.items():
-            for pid, proc in cfg['procs'].items():
-                if proc.is_running():
-                    cpu = proc.get_cpu_percent(interval=0)
-                    mem = proc.get_memory_info().rss
+        if unit != self.mem_unit:
+            self.mem_scale = diamond.convertor.binary.convert(1.0, oldUnit='byte', newUnit=unit)
+            self.mem_unit = unit
+        mem_scale = self.mem_scale
+
+        with self.lock:
+            groups = [(cfg, cfg.tracked) for cfg in self.processes.values()]
 
-                    metric_prefix = process if cfg.get('naming_method', naming_method) == 'config_title' else proc.name
-                    metric_prefix = metric_prefix.replace('.', '_')
+        # sample every process before handing anything to the handlers, so
+        #  the samples are taken as close together as possible
+        metrics = []
+        for cfg, tracked in groups:
+            dead = []
+            for pid, proc, cpu_metric, ram_metric in tracked:
+                # rather than probing every process with is_running(), just
+                #  drop the ones that have died by the time we sample them
+                try:
+                    # oneshot() lets the calls below share their /proc reads
+                    with proc.oneshot():
+                        cpu = proc.cpu_percent(interval=0)
+                        mem = proc.memory_info().rss
+                except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                    dead.append(pid)
+                    continue
+                except psutil.AccessDenied:
+                    # still running, so keep it for when access is granted
+                    continue
 
-                    if self.config['separate_pids']:
-                        metric_prefix = '.'.join([metric_prefix, str(pid)])
+                metrics.append((cpu_metric, cpu))
+                metrics.append((ram_metric, mem * mem_scale))
 
-                    metric_name = '.'.join([metric_prefix, 'cpu'])
-                    metric_value = cpu
-                    self.publish(metric_name, metric_value)
+            # prune dead processes once we're done iterating over the snapshot,
+            #  unless the refresh thread has replaced it in the meantime
+            if dead:
+                with self.lock:
+                    if cfg.tracked is tracked:
+                        for pid in dead:
+                            cfg.procs.pop(pid, None)
+                        cfg.tracked = [t for t in tracked if t[0] not in dead]
 
-                    metric_name = '.'.join([metric_prefix, 'ram'])
-                    metric_value = diamond.convertor.binary.convert(mem, oldUnit='byte', newUnit=unit)
-                    self.publish(metric_name, metric_value)
\ No newline at end of file
+        for metric_name, metric_value in metrics:
+            self.publish(metric_name, metric_value)
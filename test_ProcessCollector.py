@@ -0,0 +1,426 @@
+# coding=utf-8
+
+"""
+Tests for ProcessCollector, run with `python -m pytest` or
+`python -m unittest test_ProcessCollector` from this directory
+"""
+
+import collections
+import contextlib
+import gc
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+
+class Collector(object):
+    """
+    Minimal stand-in for diamond.collector.Collector, so that the tests
+    neither need diamond installed nor depend on how it loads configs
+    """
+
+    def __init__(self, config, handlers):
+        self.config = self.get_default_config()
+        self.config.update(config)
+        self.log = logging.getLogger('diamond')
+        self.published = []
+
+    def get_default_config_help(self):
+        return {}
+
+    def get_default_config(self):
+        return {'interval': 300}
+
+    def publish(self, name, value):
+        self.published.append((name, value))
+
+
+class binary(object):
+    """
+    Minimal stand-in for diamond.convertor.binary
+    """
+    units = {'B': 1, 'byte': 1, 'kB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+    @classmethod
+    def convert(cls, value, oldUnit, newUnit):
+        return value * cls.units[oldUnit] / float(cls.units[newUnit])
+
+
+diamond = types.ModuleType('diamond')
+diamond.collector = types.ModuleType('diamond.collector')
+diamond.collector.Collector = Collector
+diamond.convertor = types.ModuleType('diamond.convertor')
+diamond.convertor.binary = binary
+sys.modules.update({'diamond': diamond,
+                    'diamond.collector': diamond.collector,
+                    'diamond.convertor': diamond.convertor})
+
+import ProcessCollector  # noqa: E402
+
+psutil = ProcessCollector.psutil
+
+
+class CombinePatternsTest(unittest.TestCase):
+
+    def test_alternation(self):
+        search = ProcessCollector.combine_patterns(['^postgres', '^pg'])
+        self.assertTrue(search('postgres'))
+        self.assertTrue(search('pg_ctl'))
+        self.assertFalse(search('mysqld'))
+
+    def test_no_patterns(self):
+        self.assertIsNone(ProcessCollector.combine_patterns([]))
+
+    def test_global_inline_flags(self):
+        search = ProcessCollector.combine_patterns(['(?i)^postgres', '^pg'])
+        self.assertTrue(search('Postgres'))
+        self.assertTrue(search('pg'))
+        # the flag mustn't leak onto the other patterns
+        self.assertFalse(search('PG'))
+
+    def test_backreferences(self):
+        search = ProcessCollector.combine_patterns(['^x(a)', r'^(b)\1$'])
+        self.assertTrue(search('bb'))
+        self.assertTrue(search('xa'))
+        self.assertFalse(search('ba'))
+
+    def test_named_groups(self):
+        search = ProcessCollector.combine_patterns(['^a(?P<ver>\\d)',
+                                                    '^b(?P<ver>\\d)'])
+        self.assertTrue(search('a1'))
+        self.assertTrue(search('b2'))
+        self.assertFalse(search('c3'))
+
+    def test_character_classes(self):
+        # no flags on top of the ones re.compile uses by default
+        pattern = u'/opt/\\w+/bin'
+        search = ProcessCollector.combine_patterns([pattern])
+        for path in (u'/opt/cafe/bin', u'/opt/caf\xe9/bin'):
+            self.assertEqual(bool(search(path)), bool(re.search(pattern, path)))
+
+
+class LiteralPrefixTest(unittest.TestCase):
+
+    def test_literal(self):
+        self.assertEqual(ProcessCollector.literal_prefix('^postgres'), 'postgres')
+        self.assertEqual(ProcessCollector.literal_prefix('^/usr/bin/java'),
+                         '/usr/bin/java')
+
+    def test_not_literal(self):
+        for pattern in ('^warden.warden', '^foo$', '^a b', '^', 'postgres'):
+            self.assertIsNone(ProcessCollector.literal_prefix(pattern), pattern)
+
+
+def make_collector(process_config, **config):
+    """
+    Builds a ProcessCollector for the given `process` section of the config,
+    with its process descriptors set up
+    """
+    config['process'] = process_config
+    collector = ProcessCollector.ProcessCollector(config, None)
+    collector.setup_config()
+    return collector
+
+
+class SetupConfigTest(unittest.TestCase):
+
+    def test_prefilter(self):
+        collector = make_collector({'pg': {'name': ['^postgres', '^pg']},
+                                    'web': {'cmdline': 'nginx'}})
+        self.assertTrue(collector.prefilter)
+        self.assertTrue(collector.any_process.name('pg_ctl'))
+        self.assertTrue(collector.any_process.cmdline('/usr/bin/nginx -g'))
+
+    def test_literal_and_regexp_cmdline(self):
+        collector = make_collector({'pg': {'cmdline': ['^postgres',
+                                                       'pg_(ctl|dump)']}})
+        group = collector.processes['pg']
+        self.assertEqual(group.cmdline_literals, ('postgres',))
+        info = {'name': 'sh', 'exe': None}
+        for cfg in (group, collector.any_process):
+            self.assertTrue(ProcessCollector.process_filter(
+                info, cfg, 'postgres -D /var/lib/postgresql'))
+            self.assertTrue(ProcessCollector.process_filter(
+                info, cfg, '/usr/bin/pg_dump mydb'))
+            self.assertFalse(ProcessCollector.process_filter(
+                info, cfg, 'mysqld'))
+
+    def test_named_groups_across_groups(self):
+        collector = make_collector({'a': {'name': '^a(?P<ver>\\d)'},
+                                    'b': {'name': '^b(?P<ver>\\d)'}})
+        self.assertFalse(collector.prefilter)
+        self.assertTrue(collector.processes['a'].name('a1'))
+        self.assertTrue(collector.processes['b'].name('b2'))
+
+
+class RefreshThreadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.refreshed = threading.Event()
+        self.collector = ProcessCollector.ProcessCollector({}, None)
+        self.collector.refresh_processes = self.refreshed.set
+        self.collector.start_refresh_thread()
+        self.thread = self.collector.refresh_thread
+
+    def tearDown(self):
+        if self.collector is not None:
+            self.collector.stop()
+        self.thread.join(1)
+
+    def test_refreshes_when_asked(self):
+        self.assertFalse(self.refreshed.wait(0.1))
+        self.collector.refresh_wanted.set()
+        self.assertTrue(self.refreshed.wait(1))
+
+    def test_stop(self):
+        self.collector.stop()
+        self.thread.join(1)
+        self.assertFalse(self.thread.is_alive())
+
+    def test_stops_once_collected(self):
+        self.collector = None
+        gc.collect()
+        self.thread.join(1)
+        self.assertFalse(self.thread.is_alive())
+
+
+@unittest.skipIf(psutil is None, 'psutil is not installed')
+@unittest.skipUnless(sys.platform.startswith('linux'), 'Linux only')
+class ScanLinuxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.procs = []
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for proc in self.procs:
+            proc.kill()
+            proc.wait()
+            proc.stdin.close()
+        shutil.rmtree(self.tmpdir)
+
+    def spawn(self, args, comm):
+        """
+        Starts a process and waits for it to show up under the given comm
+        """
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+        self.procs.append(proc)
+        path = '/proc/%d/comm' % proc.pid
+        for _ in range(100):
+            with open(path, 'rb') as f:
+                if f.read() == comm + b'\n':
+                    return proc.pid
+            time.sleep(0.01)
+        self.fail('%r never showed up' % (args,))
+
+    def scan(self, pid):
+        for info, proc in ProcessCollector.scan_linux():
+            if info['pid'] == pid:
+                return info
+        self.fail('%d not found by scan_linux' % pid)
+
+    def assertMatchesPsutil(self, info):
+        expected = psutil.Process(info['pid']).as_dict(
+            attrs=['name', 'exe', 'cmdline'], ad_value=None)
+        self.assertEqual(dict((k, info[k]) for k in expected), expected)
+
+    def test_all_processes(self):
+        for info, proc in ProcessCollector.scan_linux():
+            try:
+                self.assertMatchesPsutil(info)
+            except psutil.NoSuchProcess:
+                pass
+
+    def test_long_name(self):
+        # comm only holds the first 15 characters of the name, the rest is
+        #  recovered from the command line
+        link = os.path.join(self.tmpdir, 'a_very_long_process_name')
+        os.symlink(shutil.which('cat') if hasattr(shutil, 'which')
+                   else '/bin/cat', link)
+        pid = self.spawn([link], b'a_very_long_pro')
+        info = self.scan(pid)
+        self.assertEqual(info['name'], 'a_very_long_process_name')
+        self.assertMatchesPsutil(info)
+
+    def test_space_separated_cmdline(self):
+        pid = self.spawn(['bash', '-c', 'exec -a "fake cmd line" cat'],
+                         b'cat')
+        info = self.scan(pid)
+        self.assertEqual(info['cmdline'], ['fake', 'cmd', 'line'])
+        self.assertMatchesPsutil(info)
+
+    def test_undecodable_name(self):
+        # only a process itself may change its comm
+        rename = ("import os, sys\n"
+                  "fd = os.open('/proc/self/comm', os.O_WRONLY)\n"
+                  "os.write(fd, b'caf\\xe9d')\n"
+                  "os.close(fd)\n"
+                  "sys.stdin.read()\n")
+        pid = self.spawn([sys.executable, '-c', rename], b'caf\xe9d')
+        info = self.scan(pid)
+        if hasattr(os, 'fsdecode'):
+            self.assertEqual(info['name'], os.fsdecode(b'caf\xe9d'))
+        else:
+            self.assertEqual(info['name'], b'caf\xe9d')
+        self.assertMatchesPsutil(info)
+
+    def test_zombie_checked_once(self):
+        checked = []
+        is_zombie = ProcessCollector.is_zombie
+
+        def check(path):
+            checked.append(path)
+            return is_zombie(path)
+        ProcessCollector.is_zombie = check
+        try:
+            list(ProcessCollector.scan_linux())
+        finally:
+            ProcessCollector.is_zombie = is_zombie
+        self.assertEqual(len(checked), len(set(checked)))
+
+    def test_skip_cmdline_and_exe(self):
+        pid = self.spawn(['cat'], b'cat')
+        for info, proc in ProcessCollector.scan_linux(read_cmdline=False,
+                                                      read_exe=False):
+            if info['pid'] == pid:
+                self.assertEqual(info['name'], 'cat')
+                self.assertIsNone(info['cmdline'])
+                self.assertIsNone(info['exe'])
+
+
+MemoryInfo = collections.namedtuple('MemoryInfo', 'rss')
+
+
+class FakeProcess(object):
+    """
+    Stands in for the psutil.Process of a process that is, or was, running
+    """
+
+    def __init__(self, pid, alive=True, denied=False):
+        self.pid = pid
+        self.alive = alive
+        self.denied = denied
+
+    @contextlib.contextmanager
+    def oneshot(self):
+        yield
+
+    def cpu_percent(self, interval=None):
+        if not self.alive:
+            raise psutil.NoSuchProcess(self.pid)
+        if self.denied:
+            raise psutil.AccessDenied(self.pid)
+        return 12.5
+
+    def memory_info(self):
+        if not self.alive:
+            raise psutil.NoSuchProcess(self.pid)
+        return MemoryInfo(2048)
+
+
+@unittest.skipIf(psutil is None, 'psutil is not installed')
+class TrackedProcessesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = make_collector({'cat': {'name': '^cat$'}},
+                                        unit='kB')
+        self.scans = 0
+
+    def tearDown(self):
+        self.collector.stop()
+        ProcessCollector.RELOAD_INTERVAL = 10
+
+    def running(self, *procs):
+        """
+        Has procs, (FakeProcess, create time) tuples, be the processes running
+        on the system from now on
+        """
+        def scan_processes():
+            self.scans += 1
+            return [({'pid': proc.pid, 'name': 'cat', 'create_time': create_time},
+                     proc)
+                    for proc, create_time in procs]
+        self.collector.scan_processes = scan_processes
+
+    def scan(self, *procs):
+        """
+        Runs filter_processes with procs as the processes running on the system
+        """
+        self.running(*procs)
+        self.collector.filter_processes()
+        return self.collector.processes['cat']
+
+    def published_pids(self):
+        pids = set(name.split('.')[1] for name, value in self.collector.published)
+        del self.collector.published[:]
+        return sorted(pids)
+
+    def test_surviving_pid_keeps_process(self):
+        first = FakeProcess(10)
+        self.scan((first, 1.0))
+        group = self.scan((FakeProcess(10), 1.0))
+        self.assertIs(group.procs[10][0], first)
+        self.assertIs(group.tracked[0][1], first)
+
+    def test_reused_pid_gets_new_process(self):
+        self.scan((FakeProcess(10), 1.0))
+        second = FakeProcess(10)
+        group = self.scan((second, 2.0))
+        self.assertIs(group.procs[10][0], second)
+        self.assertEqual(group.procs[10][1], 2.0)
+
+    def test_dead_pids_are_pruned(self):
+        alive, dead = FakeProcess(10), FakeProcess(11)
+        group = self.scan((alive, 1.0), (dead, 1.0))
+        dead.alive = False
+        self.collector.collect()
+        self.assertEqual(sorted(group.procs), [10])
+        self.assertEqual([t[0] for t in group.tracked], [10])
+        self.assertEqual(sorted(self.collector.published),
+                         [('cat.10.cpu', 12.5), ('cat.10.ram', 2.0)])
+
+    def test_access_denied(self):
+        group = self.scan((FakeProcess(10), 1.0),
+                          (FakeProcess(11, denied=True), 1.0))
+        self.collector.collect()
+        self.assertEqual(sorted(group.procs), [10, 11])
+        self.assertEqual(sorted(self.collector.published),
+                         [('cat.10.cpu', 12.5), ('cat.10.ram', 2.0)])
+
+    def test_collect_rescans_outdated_list(self):
+        self.running((FakeProcess(10), 1.0))
+        self.collector.collect()
+        self.assertEqual(self.published_pids(), ['10'])
+        # the background scan hasn't come round by the next collect
+        self.running((FakeProcess(10), 1.0), (FakeProcess(11), 1.0))
+        self.collector.last_reload -= 301
+        self.collector.collect()
+        self.assertEqual(self.published_pids(), ['10', '11'])
+
+    def test_collect_picks_up_background_scan(self):
+        ProcessCollector.RELOAD_INTERVAL = 0.1
+        self.collector.config['interval'] = 0.5
+        self.running((FakeProcess(10), 1.0))
+        self.collector.collect()
+        self.assertEqual(self.published_pids(), ['10'])
+        # the next list is scanned 0.1s before the next collect is due
+        self.running((FakeProcess(10), 1.0), (FakeProcess(11), 1.0))
+        time.sleep(0.2)
+        self.assertEqual(self.scans, 1)
+        time.sleep(0.4)
+        self.assertEqual(self.scans, 2)
+        self.collector.collect()
+        self.assertEqual(self.published_pids(), ['10', '11'])
+        self.assertEqual(self.scans, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()